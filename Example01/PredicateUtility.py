@@ -24,8 +24,18 @@ from Foundation import NSObject, NSCompoundPredicate, NSNotPredicateType, NSOrPr
 from CoreData import NSStringAttributeType, NSEqualToPredicateOperatorType, NSNotEqualToPredicateOperatorType, NSContainsPredicateOperatorType, NSBeginsWithPredicateOperatorType, NSEndsWithPredicateOperatorType
 from AppKit import NSPredicateEditorRowTemplate
 
+# print diagnostics while converting predicates
+DEBUG = False
+
+def _identity(value):
+	"""
+	Default value formatter for operators that compare against the value as is.
+	"""
+	return value
+	
 class CriteriaError(Exception):
 	def __init__(self, msg):
+		Exception.__init__(self, msg)
 		self.msg = msg
 	def __repr__(self):
 		return str(self.msg)
@@ -48,8 +58,17 @@ class PredicateEditorManager(NSObject):
 	OP_BEGINSWITH = NSBeginsWithPredicateOperatorType
 	OP_ENDSWITH = NSEndsWithPredicateOperatorType
 	
-	_supportedOperatorTypes = [OP_EQ, OP_NE, OP_CONTAINS, OP_BEGINSWITH, OP_ENDSWITH]
-	_supportedColumnTypes = [STRING]
+	# operators offered by default, in display order
+	_defaultOperatorTypes = (OP_EQ, OP_NE, OP_CONTAINS, OP_BEGINSWITH, OP_ENDSWITH)
+	
+	_supportedOperatorTypes = frozenset(_defaultOperatorTypes)
+	_supportedColumnTypes = frozenset([STRING])
+	
+	# compound types (OR, AND) offered by the nesting row template, doubling as its cache key
+	_COMPOUND_TEMPLATE_KEY = (2, 1)
+	
+	# NSNumber boxed operator types, shared by all managers once the first is initialized
+	_OP_NSNUMBERS = None
 	
 	def init(self):
 		"""
@@ -78,12 +97,27 @@ class PredicateEditorManager(NSObject):
 		"""
 		Common initialization
 		"""
-		# setup our local data
-		self._criteria = []
+		# box the supported operators once for use in every build
+		if PredicateEditorManager._OP_NSNUMBERS is None:
+			PredicateEditorManager._OP_NSNUMBERS = dict([(op, NSNumber.numberWithUnsignedInt_(op)) for op in PredicateEditorManager._supportedOperatorTypes])
+			
+		# setup our local data, each criteria is stored across these parallel lists
+		self._displayNames = []
+		self._backingNames = []
+		self._types = []
+		self._operators = []
+		
+		# row templates from previous builds, keyed by criteria position and configuration
+		self._rowTemplateCache = {}
+		
+		# column mapping and generated SQL shared by the wrappers this manager hands out,
+		# both replaced when criteria are added
+		self._wrapperMapping = None
+		self._sqlCache = {}
 		self._editor = None
 		self._isNesting = True
 		
-	def addCriteria(self, criteria, criteriaType=STRING, operators=_supportedOperatorTypes):
+	def addCriteria(self, criteria, criteriaType=STRING, operators=_defaultOperatorTypes):
 		"""
 		Add a search criteria to the NSPredicateEditor. Optionally specify
 		the type of this criteria (defaults to String) and supported operators.
@@ -97,7 +131,7 @@ class PredicateEditorManager(NSObject):
 		"""
 		self.addMappedCriteria(criteria, criteria, criteriaType=criteriaType, operators=operators)
 	
-	def addMappedCriteria(self, niceName, backingName, criteriaType=STRING, operators=_supportedOperatorTypes):
+	def addMappedCriteria(self, niceName, backingName, criteriaType=STRING, operators=_defaultOperatorTypes):
 		"""
 		Add a search criteria using a 'nice' name mapped to the actual criteria name. This makes
 		it fairly simple to have localized readable names mapped to backing column names that
@@ -116,14 +150,37 @@ class PredicateEditorManager(NSObject):
 		if criteriaType not in PredicateEditorManager._supportedColumnTypes:
 			raise CriteriaError("Unsupported criteria type specified")
 			
-		self._criteria.append(
+		self._displayNames.append(niceName)
+		self._backingNames.append(backingName)
+		self._types.append(criteriaType)
+		self._operators.append(operators)
+		self._wrapperMapping = None
+		self._sqlCache = {}
+		
+	def _mapping(self):
+		"""
+		Build the display name to backing name mapping handed to PredicateWrapper. The lists
+		are zipped in reverse so the first criteria for a repeated display name wins.
+		"""
+		return dict(zip(reversed(self._displayNames), reversed(self._backingNames)))
+		
+	def criteria(self):
+		"""
+		Retrieve the configured criteria as a list of dictionaries, in the form accepted
+		by PredicateWrapper:
+			
+			{'displayName': "Column 1", 'backingName': "column1", 'type': STRING, 'operators': [...]}
+			
+		"""
+		return [
 			{
-				'displayName': niceName,
+				'displayName': displayName,
 				'backingName': backingName,
 				'type': criteriaType,
 				'operators': operators
 			}
-		)
+			for displayName, backingName, criteriaType, operators in zip(self._displayNames, self._backingNames, self._types, self._operators)
+		]
 		
 	def isNesting(self, nesting = None):
 		"""
@@ -142,6 +199,9 @@ class PredicateEditorManager(NSObject):
 		Set the NSPredicateEditor associated with this Manager
 		"""
 		self._editor = ed
+		
+		# row templates belong to the editor they were built for
+		self._rowTemplateCache = {}
 	
 	def predicateEditor(self):
 		"""
@@ -154,23 +214,32 @@ class PredicateEditorManager(NSObject):
 		Build and configure the NSPredicatEditor using the configured criteria.
 		"""
 		predicateSet = []
+		cache = self._rowTemplateCache
 		
 		# if nesting is supported we first add the compound type predicate
 		if self._isNesting:
-			basePred = NSPredicateEditorRowTemplate.alloc().initWithCompoundTypes_([2, 1])
+			basePred = cache.get(self._COMPOUND_TEMPLATE_KEY)
+			if basePred is None:
+				basePred = NSPredicateEditorRowTemplate.alloc().initWithCompoundTypes_(list(self._COMPOUND_TEMPLATE_KEY))
+				cache[self._COMPOUND_TEMPLATE_KEY] = basePred
 			predicateSet.append(basePred)
 		
-		# now convert each criteria into a predicate template
-		for criteria in self._criteria:
-			lexp = [NSExpression.expressionForConstantValue_(criteria['displayName'])]
-			ops = [NSNumber.numberWithUnsignedInt_(i) for i in criteria['operators']]
-			predicate = NSPredicateEditorRowTemplate.alloc().initWithLeftExpressions_rightExpressionAttributeType_modifier_operators_options_(
-				lexp,
-				criteria['type'],
-				NSAnyPredicateModifier,
-				ops,
-				0
-			)
+		# now convert each criteria into a predicate template, reusing any built previously
+		opNumbers = self._OP_NSNUMBERS
+		for index, (displayName, criteriaType, operators) in enumerate(zip(self._displayNames, self._types, self._operators)):
+			key = (index, displayName, criteriaType, tuple(operators))
+			predicate = cache.get(key)
+			if predicate is None:
+				lexp = [NSExpression.expressionForConstantValue_(displayName)]
+				ops = [opNumbers[i] if i in opNumbers else NSNumber.numberWithUnsignedInt_(i) for i in operators]
+				predicate = NSPredicateEditorRowTemplate.alloc().initWithLeftExpressions_rightExpressionAttributeType_modifier_operators_options_(
+					lexp,
+					criteriaType,
+					NSAnyPredicateModifier,
+					ops,
+					0
+				)
+				cache[key] = predicate
 			predicateSet.append(predicate)
 		
 		# set the final predicate templates
@@ -186,14 +255,20 @@ class PredicateEditorManager(NSObject):
 	def wrappedPredicate(self):
 		"""
 		Retrieve the NSPredicate of the NSPredicateEditor wrapped in a PredicateWrapper
-		object. This is a convenience method identical to:
+		object. This is a convenience method equivalent to:
 			
 			pred = manager.predicate()
 			criteria = manager.criteria()
 			wpred = PredicateWrapper(pred, criteria = criteria)
 			
+		Each call returns a new PredicateWrapper, but the wrappers share the manager's SQL
+		cache, so converting an unchanged predicate again is served from that cache.
 		"""
-		return PredicateWrapper(self.predicate(), criteria = self._criteria)
+		# build the column mapping once, only if criteria were added since the last call
+		if self._wrapperMapping is None:
+			self._wrapperMapping = self._mapping()
+			
+		return PredicateWrapper(self.predicate(), mapping = self._wrapperMapping, sqlCache = self._sqlCache)
 		
 	def addRow(self):
 		"""
@@ -207,20 +282,63 @@ class PredicateWrapper(object):
 	specifically NSCompoundPredicate) into SQL WHERE clauses.
 	"""
 	
-	OPERATORS = {
-		NSEqualToPredicateOperatorType: {'op': "=", 'format': "%s"},
-		NSNotEqualToPredicateOperatorType: {'op': "!=", 'format': "%s"},
-		NSBeginsWithPredicateOperatorType: {'op': "LIKE", 'format': "%s%%"},
-		NSEndsWithPredicateOperatorType: {'op': "LIKE", 'format': "%%%s"},
-		NSContainsPredicateOperatorType: {'op': "LIKE", 'format': "%%%s%%"}
+	# sql comparator for each operator type
+	_OP_SQL = {
+		NSEqualToPredicateOperatorType: "=",
+		NSNotEqualToPredicateOperatorType: "!=",
+		NSBeginsWithPredicateOperatorType: "LIKE",
+		NSEndsWithPredicateOperatorType: "LIKE",
+		NSContainsPredicateOperatorType: "LIKE"
+	}
+	
+	# formatting of the compared value, operators not listed use the value as is
+	_OP_FMT = {
+		NSBeginsWithPredicateOperatorType: lambda v: v + "%",
+		NSEndsWithPredicateOperatorType: lambda v: "%" + v,
+		NSContainsPredicateOperatorType: lambda v: "%" + v + "%"
 	}
 
-	def __init__(self, pred, criteria=None):
+	# predicate type to conversion handler, shared by all wrappers once the first is created
+	_DISPATCH = None
+	
+	# handled predicate types, most specific first, for matching subclasses
+	_DISPATCH_ORDER = (NSCompoundPredicate, NSComparisonPredicate, NSPredicate)
+	
+	def __init__(self, pred, criteria=None, mapping=None, sqlCache=None):
 		"""
-		Create a PredicateWrapper around an NSPredicate
+		Create a PredicateWrapper around an NSPredicate. Column names are resolved either from
+		a list of criteria dictionaries, or from a mapping of display names to backing names.
+		
+		An sqlCache dictionary may be shared between wrappers using the same column mapping,
+		so SQL generated by one is reused by the others. Changing the criteria or mapping of
+		a wrapper detaches it from the shared cache.
+		"""
+		self._predicate = pred
+		self._display2backing = None
+		if PredicateWrapper._DISPATCH is None:
+			PredicateWrapper._DISPATCH = {
+				NSCompoundPredicate: PredicateWrapper._toSQLCompound,
+				NSComparisonPredicate: PredicateWrapper._toSQLComparison,
+				NSPredicate: PredicateWrapper._toSQLBase
+			}
+		if mapping is not None:
+			self.setMapping(mapping)
+		else:
+			self.setCriteria(criteria)
+		if sqlCache is not None:
+			self._sqlCache = sqlCache
+		
+	def predicate(self):
+		"""
+		Retrieve the wrapped NSPredicate.
+		"""
+		return self._predicate
+		
+	def setPredicate(self, pred):
+		"""
+		Set the NSPredicate to be wrapped.
 		"""
 		self._predicate = pred
-		self._criteria = criteria
 		
 	def criteria(self):
 		"""
@@ -234,13 +352,47 @@ class PredicateWrapper(object):
 		determine the actual column name (in the case of mapped columns) and the column Type.
 		"""
 		self._criteria = criteria
+		
+		# index the display names so column lookups during conversion are a single dict hit,
+		# built in reverse so the first criteria for a repeated display name wins
+		if criteria is None:
+			self._display2backing = None
+		else:
+			self._display2backing = dict([(c['displayName'], c['backingName']) for c in reversed(criteria)])
+		
+		# the column mapping changed, so any previously generated sql is stale
+		self._sqlCache = {}
+		
+	def mapping(self):
+		"""
+		Retrieve the mapping of display names to backing names used when evaluating an
+		NSPredicate conversion.
+		"""
+		return self._display2backing
+		
+	def setMapping(self, mapping):
+		"""
+		Set the mapping of display names to backing names directly, in place of a list of
+		criteria. The mapping is used as is and should not be modified afterwards.
+		"""
+		self._criteria = None
+		self._display2backing = mapping
+		
+		# the column mapping changed, so any previously generated sql is stale
+		self._sqlCache = {}
 	
 	def toSQL(self):
 		"""
 		Convert the wrapped NSPredicate into a SQL statement that can be used in a WHERE
-		clause.
+		clause. The generated SQL is cached against the predicate format, so converting an
+		unchanged predicate repeatedly is a single dictionary lookup.
 		"""
-		sql = self._toSQL(self._predicate)
+		key = self._predicate.predicateFormat()
+		cache = self._sqlCache
+		if key in cache:
+			return cache[key]
+			
+		sql = self._toSQL(self._predicate, {})
 		
 		# our generated sql will likely have parenthetical wrappers as a side effect of the
 		# recursion, remove these if they exist
@@ -248,61 +400,135 @@ class PredicateWrapper(object):
 			sql = sql[1:]
 		if sql.endswith(')'):
 			sql = sql[:-1]
-			
+		
+		# only the most recent conversion is kept
+		cache.clear()
+		cache[key] = sql
 		return sql
 	
-	def _toSQL(self, fpred):
+	def _toSQL(self, root, cache):
 		"""
-		Internal recursive method for decomposing NSPredicate objects. This method should never
+		Internal method for decomposing NSPredicate objects. This method should never
 		be directly called. Instead, call PredicateWrapper::toSQL()
+		
+		The predicate tree is walked post-order with an explicit stack rather than by
+		recursion. Compound predicates are pushed twice: once to expand their subpredicates,
+		and again, carrying those subpredicates, to join the converted clauses left on the
+		results stack.
+		
+		The cache maps id(predicate) to a (predicate, sql) pair for the duration of a single
+		toSQL() call, so repeated subpredicates are only converted once. The predicate is held
+		in the pair to keep its id from being reused while the cache is alive.
 		"""
-		if type(fpred) == NSCompoundPredicate:
-			
-			compoundType = fpred.compoundPredicateType()
-			compoundOp = None
+		results = []
+		stack = [(root, None)]
+		
+		while stack:
+			fpred, subpreds = stack.pop()
+			key = id(fpred)
 			
-			if compoundType == NSNotPredicateType:
-				compoundOp = ' NOT '
-			elif compoundType == NSAndPredicateType:
-				compoundOp = ' AND '
-			elif compoundType == NSOrPredicateType:
-				compoundOp = ' OR '
+			if subpreds is None:
+				if key in cache:
+					results.append(cache[key][1])
+					continue
+					
+				if isinstance(fpred, NSCompoundPredicate):
+					# revisit this predicate once all of its subpredicates are converted
+					subpreds = list(fpred.subpredicates())
+					stack.append((fpred, subpreds))
+					for spred in reversed(subpreds):
+						stack.append((spred, None))
+					continue
+				
+				sql = self._convert(fpred, None)
+			else:
+				split = len(results) - len(subpreds)
+				sql = self._convert(fpred, results[split:])
+				del results[split:]
 			
-			subClauses = []
-			for spred in fpred.subpredicates():
-				subClauses.append(self._toSQL(spred))
+			cache[key] = (fpred, sql)
+			results.append(sql)
+		
+		return results[0]
+		
+	def _convert(self, fpred, subClauses):
+		"""
+		Convert a single NSPredicate node by dispatching on its type. Compound predicates
+		receive the already converted clauses of their subpredicates.
+		"""
+		handler = self._DISPATCH.get(type(fpred))
+		if handler is None:
+			# fall back to the most specific handled base class, and remember the
+			# handler so further instances of this type are a direct hit
+			for cls in self._DISPATCH_ORDER:
+				if isinstance(fpred, cls):
+					handler = self._DISPATCH[cls]
+					self._DISPATCH[type(fpred)] = handler
+					break
+			else:
+				if DEBUG:
+					print "Unknown predicate type: ", type(fpred)
+				return None
 			
-			return "(" + compoundOp.join(subClauses) + ")"
-		elif type(fpred) == NSPredicate:
+		return handler(self, fpred, subClauses)
 		
-			# shouldn't ever really hit this directly
+	def _toSQLCompound(self, fpred, subClauses):
+		"""
+		Join the converted subpredicate clauses of an NSCompoundPredicate.
+		"""
+		compoundType = fpred.compoundPredicateType()
+		compoundOp = None
+		
+		if compoundType == NSNotPredicateType:
+			compoundOp = ' NOT '
+		elif compoundType == NSAndPredicateType:
+			compoundOp = ' AND '
+		elif compoundType == NSOrPredicateType:
+			compoundOp = ' OR '
+		
+		return "(" + compoundOp.join(subClauses) + ")"
+		
+	def _toSQLBase(self, fpred, subClauses):
+		"""
+		Convert a plain NSPredicate.
+		"""
+		# shouldn't ever really hit this directly
+		if DEBUG:
 			print "NSPredicate"
-			
-		elif type(fpred) == NSComparisonPredicate:
-			
-			# find the comparison column
-			lexp = fpred.leftExpression().constantValue()
-			compCol = self._backingNameForDisplayName(lexp)
-			
-			# find the sql comparator
-			mappedOp = self.OPERATORS[fpred.predicateOperatorType()]
-
-			op = mappedOp['op']
-			rexp = mappedOp['format'] % (fpred.rightExpression().constantValue())
-						
-			return "%s %s \"%s\"" % (compCol, op, rexp)
-		else:
-			print "Unknown predicate type: ", type(fpred)
+		
+	def _toSQLComparison(self, fpred, subClauses):
+		"""
+		Convert an NSComparisonPredicate into a single column comparison.
+		"""
+		# each accessor is an Objective-C message, so fetch them once
+		left = fpred.leftExpression()
+		right = fpred.rightExpression()
+		opType = fpred.predicateOperatorType()
+		
+		# find the comparison column
+		lexp = left.constantValue()
+		compCol = self._backingNameForDisplayName(lexp)
+		if compCol is None:
+			raise CriteriaError("No criteria mapped for display name: %s" % lexp)
+		if not isinstance(compCol, basestring):
+			compCol = '%s' % (compCol,)
+		
+		# the value formatters expect a string, so convert other constants (numbers, nil) once
+		value = right.constantValue()
+		if not isinstance(value, basestring):
+			value = '%s' % (value,)
+		
+		# find the sql comparator
+		op = self._OP_SQL[opType]
+		rexp = self._OP_FMT.get(opType, _identity)(value)
+					
+		return ''.join((compCol, ' ', op, ' "', rexp, '"'))
 			
 	def _backingNameForDisplayName(self, dn):
 		"""
 		Retrieve the backing criteria name for a given display name.
 		"""
-		if self._criteria is None:
+		if self._display2backing is None:
 			return dn
 			
-		for criteria in self._criteria:
-			if criteria['displayName'] == dn:
-				return criteria['backingName']
-		
-		return None
\ No newline at end of file
+		return self._display2backing.get(dn)
\ No newline at end of file